@@ -11,5 +11,5 @@ if os_name == 'posix':
     from rpcbridge import ForkedRPCBridge
 del os_name
 from events import DeferredCall, PeriodicCall, PropagatingCall
-from netrpc import NetRPCSocket
+from netrpc import NetRPCSocket, NetRPCPool
 
@@ -641,6 +641,7 @@ class ManagedSocket(object):
                 break
 
         if not len(self._wbuf) and self._lwb:
+            self._lwb = False
             self.muxer.delWriter(self)
 
         return True
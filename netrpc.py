@@ -4,36 +4,173 @@
 
     This library provides a simple unencrypted, authenticated RPC
     system. Since it uses cPickle arguments can be any normal
-    Python type.
+    Python type. Calls that only pass ints, floats and strings skip
+    cPickle and are sent in a compact binary format instead. When both
+    sides have msgpack 0.6.1 or newer installed, other calls of plain
+    types use msgpack.
 """
 
 from mulsoc import ManagedSocket
-from struct import pack, unpack, calcsize
-from cPickle import dumps, loads
+from events import PeriodicCall
+from collections import OrderedDict
+from struct import Struct, error as StructError
+from cPickle import dumps, loads, HIGHEST_PROTOCOL, UnpicklingError
+from keyword import iskeyword
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# The unpack options used need msgpack 0.6.1, don't use older versions
+if msgpack is not None and msgpack.version < (0, 6, 1):
+    msgpack = None
 
 # Header and magic trailer
 RPC_HEADER_FORMAT = '!H'
-RPC_HEADER_SIZE = calcsize(RPC_HEADER_FORMAT)
+_HDR = Struct(RPC_HEADER_FORMAT)
+RPC_HEADER_SIZE = _HDR.size
 RPC_MAGIC = '#42!'
 RPC_MAGIC_LENGTH = len(RPC_MAGIC)
 
+# RPC payload codecs, every payload starts with one of these
+RPC_CODEC_PICKLE, RPC_CODEC_BINARY, RPC_CODEC_MSGPACK = '\x00', '\x01', '\x02'
+
+# Codec advertised to the peer after the authentication line
+if msgpack is None:
+    RPC_CODEC_LOCAL = RPC_CODEC_PICKLE
+else:
+    RPC_CODEC_LOCAL = RPC_CODEC_MSGPACK
+
+# Binary codec call header and argument formats
+RPC_ARG_STR, RPC_ARG_INT, RPC_ARG_FLOAT = 's', 'i', 'f'
+_CALL = Struct('!cIH')
+_ARG_STR = Struct('!cI')
+_ARG_INT = Struct('!cq')
+_ARG_FLOAT = Struct('!cd')
+
+# Amount of consumed stream data tolerated before compacting the buffer
+RPC_STREAM_COMPACT = 65536
+
 # Arg check regexes
 from re import compile as regex
-rx_arg = regex('[a-zA-Z_]+')
+rx_arg = regex('[a-zA-Z_][a-zA-Z0-9_]*\\Z')
+rx_nonident = regex('[^a-zA-Z0-9_]')
+
+# Errors raised by the payload codecs on malformed RPCs, msgpack raises
+# ValueError subclasses
+RPC_DECODE_ERRORS = (StructError, ValueError, EOFError, UnpicklingError)
+
+# Shared keyword arguments of calls that have none, never modified
+_EMPTY = {}
+
+# Source of the generated RemoteProcedureCall trampolines, the factory
+# binds the send function, RPC-ID and default values as closure variables.
+TRAMPOLINE_SOURCE = """
+def _rpc_factory(_rpc_send, _rpc_id, _rpc_defaults, _rpc_empty):
+    def %s(%s):
+        return _rpc_send(_rpc_id, %s, %s)
+    return %s
+"""
+
+def _encodeBinary(id, args):
+    """
+        Encode a call to RPC 'id' using the binary codec.
+        Returns None if 'args' contains anything but ints, floats and strings.
+    """
+
+    parts = [_CALL.pack(RPC_CODEC_BINARY, id, len(args))]
+    for a in args:
+        t = type(a)
+        if t is str:
+            parts.append(_ARG_STR.pack(RPC_ARG_STR, len(a)))
+            parts.append(a)
+        elif t is int:
+            parts.append(_ARG_INT.pack(RPC_ARG_INT, a))
+        elif t is float:
+            parts.append(_ARG_FLOAT.pack(RPC_ARG_FLOAT, a))
+        else:
+            return None
+    return ''.join(parts)
+
+def _decodeBinary(buf, off):
+    """
+        Decode a binary codec call starting at 'off' in 'buf'.
+        Returns the (id, args) tuple of the call.
+    """
+
+    codec, id, argc = _CALL.unpack_from(buf, off)
+    off += _CALL.size
+    args = []
+    for i in xrange(argc):
+        if buf.startswith(RPC_ARG_STR, off):
+            length = _ARG_STR.unpack_from(buf, off)[1]
+            off += _ARG_STR.size
+            args.append(bytes(buf[off:off + length]))
+            off += length
+        elif buf.startswith(RPC_ARG_INT, off):
+            args.append(_ARG_INT.unpack_from(buf, off)[1])
+            off += _ARG_INT.size
+        else:
+            args.append(_ARG_FLOAT.unpack_from(buf, off)[1])
+            off += _ARG_FLOAT.size
+    return id, tuple(args)
+
+def _decodeCall(buf, start, end):
+    """
+        Decode the RPC payload between 'start' and 'end' in 'buf'.
+        Returns an (id, args) or (id, args, keys) tuple.
+    """
+
+    if buf.startswith(RPC_CODEC_BINARY, start):
+        return _decodeBinary(buf, start)
+    elif buf.startswith(RPC_CODEC_MSGPACK, start):
+        return msgpack.unpackb(buf[start + 1:end], raw = False,
+            strict_map_key = False)
+    return loads(bytes(buf[start + 1:end]))
+
+def _dumpsPickle(id, args, keys):
+    """
+        Encode a call to RPC 'id' using cPickle.
+        Empty keyword arguments are left out of the encoded call.
+    """
+
+    if keys:
+        return RPC_CODEC_PICKLE + dumps((id, args, keys), HIGHEST_PROTOCOL)
+    return RPC_CODEC_PICKLE + dumps((id, args), HIGHEST_PROTOCOL)
+
+def _dumpsMsgpack(id, args, keys):
+    """
+        Encode a call to RPC 'id' using msgpack, falls back to cPickle for
+        arguments msgpack can not reproduce exactly (like tuples).
+    """
+
+    call = [id, list(args)]
+    if keys:
+        call.append(keys)
+    try:
+        return RPC_CODEC_MSGPACK + msgpack.packb(call,
+            use_bin_type = True, strict_types = True)
+    except (TypeError, ValueError, OverflowError):
+        return _dumpsPickle(id, args, keys)
 
 class RemoteProcedureCall(object):
     """
         This class represents a single remote method.
     """
 
-    # RPC calls will be wrapped by pickle in the following format
-    # (<call nr>, ((varargs), {keyargs}))
+    # RPC calls are sent as a codec byte followed by the encoded call:
+    # RPC_CODEC_BINARY: <call nr> and typed int, float and str arguments,
+    # used for calls without keyword arguments.
+    # RPC_CODEC_MSGPACK / RPC_CODEC_PICKLE: (<call nr>, (args)) or
+    # (<call nr>, (args), {keyargs}), keyargs are only sent when present.
 
-    def __init__(self, rpconn, id, args_r, args_def, args_var, args_key):
+    def __init__(self, rpconn, id, args_r, args_def, args_var, args_key,
+            name = None):
         """
             rpconn: is the RPC socket.
             id: is the RPC-ID that is used to identify the call
             on the other side of the connection.
+            name: is the name the call was exported under.
             func: is the function that should be called.
             argd_dsc: is the argument description or None if no
             argument protection is available.
@@ -42,22 +179,68 @@ class RemoteProcedureCall(object):
         # Base settings
         self.rpconn = rpconn
         self.id = id
+        self.name = name
 
-        self.args_r, self.args_def, self.args_var, self.args_key = \
-            args_r, args_def, args_var, args_key
-
-        # Build fastcall dictionary
-        arg_lookup = {}
-
-        # Walk arguments and validate
-        reg_args = self.args_r + map(lambda x: x[0], self.args_def)
-        for i in xrange(len(reg_args)):
-            arg = reg_args[i]
+        self._setSignature(args_r, args_def, args_var, args_key)
 
-            # Regular arguments
-            arg_lookup[arg] = i
+    def _setSignature(self, args_r, args_def, args_var, args_key):
+        """
+            Set the argument format of the remote method and prepare
+            the calling code for it.
+        """
 
-        self.arg_lookup = arg_lookup
+        self.args_r, self.args_def, self.args_var, self.args_key = \
+            list(args_r), list(args_def), args_var, args_key
+
+        # Names of the regular and default arguments in declaration order
+        self._arg_names = tuple(self.args_r + [x[0] for x in self.args_def])
+
+        # Prefer a generated trampoline over walking the format every call
+        self._call = self._buildTrampoline()
+        if self._call is None:
+            self._call = self._callGeneric
+
+    def _buildTrampoline(self):
+        """
+            Generate a function taking exactly the arguments of the
+            remote method, and sending them.
+            Returns None if the argument names can't be used as
+            Python identifiers.
+        """
+
+        names = self._arg_names
+        for name in names:
+            if rx_arg.match(name) is None or iskeyword(name) or \
+                    name.startswith('_rpc_'):
+                return None
+
+        params = self.args_r + ['%s=_rpc_defaults[%i]' %
+            (self.args_def[i][0], i) for i in xrange(len(self.args_def))]
+        packed = '(%s)' % ''.join([name + ', ' for name in names])
+        keys = '_rpc_empty'
+        if self.args_var:
+            params.append('*_rpc_args')
+            packed += ' + _rpc_args'
+        if self.args_key:
+            params.append('**_rpc_keys')
+            keys = '_rpc_keys'
+
+        # Name the function after the RPC, so argument errors mention it
+        func = str(rx_nonident.sub('_', '%s' % (self.name,)))
+        if rx_arg.match(func) is None or iskeyword(func) or \
+                func == 'None' or func.startswith('_rpc_'):
+            func = 'rpc_' + func
+
+        # Duplicate names and the like are refused by the compiler
+        namespace = {}
+        try:
+            exec TRAMPOLINE_SOURCE % (func, ', '.join(params), packed, keys,
+                func) in namespace
+        except SyntaxError:
+            return None
+
+        return namespace['_rpc_factory'](self.rpconn._sendCall, self.id,
+            [x[1] for x in self.args_def], _EMPTY)
 
     def __call__(self, *args, **keys):
         """
@@ -66,10 +249,27 @@ class RemoteProcedureCall(object):
             Arguments should be according to argument format
             provided.
         """
+        return self._call(*args, **keys)
+
+    def _callGeneric(self, *args, **keys):
+        """
+            Perform RPC call by walking the argument format, used when
+            no trampoline could be generated.
+        """
+
+        # Calls passing every argument positionally need no reconciliation
+        if not keys:
+            n = len(self.args_r) + len(self.args_def)
+            if len(args) == n or (len(args) > n and self.args_var):
+                return self.rpconn._sendCall(self.id, args, _EMPTY)
 
         for k in keys:
-            if self.arg_lookup[k] < len(args):
-                raise TypeError("RPC got multiple values for " + k)
+            try:
+                if self._arg_names.index(k) < len(args):
+                    raise TypeError("RPC got multiple values for " + k)
+            except ValueError:
+                # Not a named argument, checked against args_key below
+                pass
 
         args = list(args)
 
@@ -101,7 +301,7 @@ class RemoteProcedureCall(object):
         if len(keys) and not self.args_key:
             raise TypeError("Unexpected keyword arguments")
 
-        return self.rpconn._sendRPC(dumps((self.id, tuple(args), keys)))
+        return self.rpconn._sendCall(self.id, tuple(args), keys)
 
 class NetRPCSocket(ManagedSocket):
     """
@@ -121,18 +321,29 @@ class NetRPCSocket(ManagedSocket):
         # Authentication strings
         self.id = self.key = ''
 
-        # Data stream buffer and unpack variables
-        self.stream = ''
-        self.next_rpc_size = 0
+        # Payload encoder, upgraded during authentication
+        self._dumps = _dumpsPickle
+
+        # Nesting depth of RPC bursts and the RPCs they queued,
+        # see _beginBurst()
+        self._burst = 0
+        self._burst_parts = []
+
+        # Data stream buffer, read cursor and lost framing flag
+        self.stream = bytearray()
+        self._pos = 0
+        self.resync = False
 
         # Remote procedure function list
         self.rpflist = [self._export_callback]
 
-        # Exported symbols
-        self.xsymbols = {None : self._export_callback}
+        # Exported symbols, RPC0 is the export callback
+        self.xsymbols = {None : 0}
+        self._next_export_id = 1
 
         # Importable symbols
-        self.isymbols = {None : None}
+        self.isymbols = {}
+        self._next_import_id = 1
 
     def onAccept(self, sock):
         """
@@ -147,13 +358,16 @@ class NetRPCSocket(ManagedSocket):
             the _onRPCRecv method.
         """
 
-        self.stream += data
+        self.stream.extend(data)
         r = self.stream.find('\r\n')
-        if r != -1:
+
+        # Wait for the line and the peer's codec following it
+        if r != -1 and len(self.stream) > r + 2:
             if self.master:
                 if self.stream[:r] == self.key:
                     self.onRecv = self._onRecvRPC
-                    self.stream = self.stream[r + 2:]
+                    self._negotiateCodec(r + 2)
+                    del self.stream[:r + 3]
                     self._runSetup()
 
                     # Following the key there could've been RPCs
@@ -165,8 +379,9 @@ class NetRPCSocket(ManagedSocket):
             else:
                 if self.stream[:r] == 'RPC:%s' % self.id:
                     self.onRecv = self._onRecvRPC
-                    self.stream = self.stream[r + 2:]
-                    self.send('%s\r\n' % self.key)
+                    self._negotiateCodec(r + 2)
+                    del self.stream[:r + 3]
+                    self.send('%s\r\n%s' % (self.key, RPC_CODEC_LOCAL))
                     self._runSetup()
 
                     # Following the ID there couldn't have been any RPCs
@@ -174,44 +389,80 @@ class NetRPCSocket(ManagedSocket):
                     self.onAuthFail()
                     self.close()
 
+    def _negotiateCodec(self, pos):
+        """
+            Select the payload encoder based on the codec the peer
+            advertised at 'pos' in the stream.
+        """
+        if msgpack is not None and \
+                self.stream.startswith(RPC_CODEC_MSGPACK, pos):
+            self._dumps = _dumpsMsgpack
+
     def _onRecvRPC(self, data):
         """
             Handle RPC stream from the other side.
         """
-        self.stream += data
-
-        while self.isConnected():
-            # Fetch next RPC message size
-            if self.next_rpc_size == 0 and len(self.stream) >= RPC_HEADER_SIZE:
-                d = self.stream[:RPC_HEADER_SIZE]
-                self.stream = self.stream[RPC_HEADER_SIZE:]
-                self.next_rpc_size = unpack(RPC_HEADER_FORMAT, d)[0]
 
-            # Scan for magic if we lost the normal signal
-            elif self.next_rpc_size == -1:
-                x = self.stream.find(RPC_MAGIC)
-                if x == -1:
-                    return True
-                self.stream = self.stream[x + RPC_MAGIC_LENGTH:]
-                self.next_rpc_size = 0
-                continue
+        # Work on locals, the cursor is stored back on the way out
+        stream = self.stream
+        stream.extend(data)
+        pos = self._pos
+        rpflist = self.rpflist
+
+        try:
+            while self.isConnected():
+
+                # Scan for magic if we lost the normal signal
+                if self.resync:
+                    x = stream.find(RPC_MAGIC, pos)
+                    if x == -1:
+                        # Only the tail could still be the start of a magic,
+                        # skip the rest so it is never searched again
+                        pos = max(pos, len(stream) - RPC_MAGIC_LENGTH + 1)
+                        break
+                    pos = x + RPC_MAGIC_LENGTH
+                    self.resync = False
+                    continue
 
-            if len(self.stream) >= self.next_rpc_size + RPC_MAGIC_LENGTH:
+                # Wait for the complete RPC, from header to magic trailer
+                if len(stream) - pos < RPC_HEADER_SIZE:
+                    break
+                start = pos + RPC_HEADER_SIZE
+                end = start + _HDR.unpack_from(stream, pos)[0]
+                if len(stream) < end + RPC_MAGIC_LENGTH:
+                    break
 
                 # Validate RPC request
-                if self.stream[self.next_rpc_size:self.next_rpc_size +
-                        RPC_MAGIC_LENGTH] == RPC_MAGIC:
-                    rpcstr = self.stream[:self.next_rpc_size]
-                    self.stream = self.stream[self.next_rpc_size +
-                        RPC_MAGIC_LENGTH:]
-                    self.next_rpc_size = 0
-                    id, args, keywords = loads(rpcstr)
-                    self.rpflist[id](*args, **keywords)
+                if not stream.startswith(RPC_MAGIC, end):
+                    pos = start
+                    self.resync = True
                     continue
+
+                pos = end + RPC_MAGIC_LENGTH
+
+                try:
+                    call = _decodeCall(stream, start, end)
+                except RPC_DECODE_ERRORS:
+                    self.onDecodeFail(bytes(stream[start:end]))
+                    self.close()
+                    break
+
+                # Keyword arguments are only sent when there are any
+                if len(call) > 2:
+                    rpflist[call[0]](*call[1], **call[2])
                 else:
-                    self.next_rpc_size = -1
-                    continue
-            return True
+                    rpflist[call[0]](*call[1])
+        finally:
+            self._pos = pos
+
+        # Drop consumed data, without moving the buffer on every RPC
+        if self._pos == len(self.stream):
+            del self.stream[:]
+            self._pos = 0
+        elif self._pos > RPC_STREAM_COMPACT:
+            del self.stream[:self._pos]
+            self._pos = 0
+        return True
 
     def _runSetup(self):
         """
@@ -219,10 +470,14 @@ class NetRPCSocket(ManagedSocket):
             This method is called after authentication.
         """
 
-        self.onExport()
+        self._beginBurst()
+        try:
+            self.onExport()
 
-        # Notify export completion.
-        self._sendRPC(dumps((0, (None, None, None, None, None), {})))
+            # Notify export completion.
+            self._sendCall(0, (None, None, None, None, None), {})
+        finally:
+            self._endBurst()
 
     def _export_callback(self, name, args_r, args_def, args_var, args_key):
         """
@@ -236,14 +491,15 @@ class NetRPCSocket(ManagedSocket):
 
         # Update old RPC
         elif name in self.isymbols:
-            x = self.isymbols[name]
-            x.args_r, x.args_def, x.args_var, x.args_key = \
-                args_r, args_def, args_var, args_key
+            self.isymbols[name]._setSignature(args_r, args_def, args_var,
+                args_key)
 
         # Register new RPC
         else:
-            self.isymbols[name] = RemoteProcedureCall(self, len(self.isymbols),
-                args_r, args_def, args_var, args_key)
+            self.isymbols[name] = RemoteProcedureCall(self,
+                self._next_import_id, args_r, args_def, args_var, args_key,
+                name)
+            self._next_import_id += 1
 
     def setIdentification(self, id):
         """
@@ -263,7 +519,7 @@ class NetRPCSocket(ManagedSocket):
             is to send the RPC identification to the connecting socket.
         """
         self.master = True
-        self.send('RPC:%s\r\n' % self.id)
+        self.send('RPC:%s\r\n%s' % (self.id, RPC_CODEC_LOCAL))
 
     def exportRPC(self, name, func, args_r = [], args_def = [],
             args_var = False, args_key = False):
@@ -283,24 +539,23 @@ class NetRPCSocket(ManagedSocket):
             args_key: A boolean toggling the keyword arguments feature.
         """
 
-        # Walk arguments and validate
-        reg_args = args_r + map(lambda x: x[0], args_def)
-        for i in xrange(len(reg_args)):
-            arg = reg_args[i]
+        # The argument format is always sent as lists
+        args_r, args_def = list(args_r), list(args_def)
 
-            # Regular arguments
-            if rx_arg.match(arg) is None:
-                raise TypeError("Argument format invalid")
-
-        if name in self.xsymbols:
-            # Replace old RPC call
-            self.rpflist[self.xsymbols[name]] = func
-        else:
+        # Validate argument names
+        if not all(rx_arg.match(arg) for arg in args_r) or \
+                not all(rx_arg.match(x[0]) for x in args_def):
+            raise TypeError("Argument format invalid")
 
+        id = self.xsymbols.setdefault(name, self._next_export_id)
+        if id == self._next_export_id:
             # Add new RPC call
-            self.xsymbols[name] = len(self.xsymbols)
+            self._next_export_id += 1
             self.rpflist.append(func)
-        self._sendRPC(dumps((0, (name, args_r, args_def, args_var, args_key), {})))
+        else:
+            # Replace old RPC call
+            self.rpflist[id] = func
+        self._sendCall(0, (name, args_r, args_def, args_var, args_key), {})
 
     def importRPC(self, symname):
         """
@@ -311,11 +566,47 @@ class NetRPCSocket(ManagedSocket):
             return self.isymbols[symname]
         return None
 
+    def _sendCall(self, id, args, keys):
+        """
+            Internal function for encoding and sending a call to RPC 'id'.
+        """
+
+        if not keys:
+            rpcstr = _encodeBinary(id, args)
+            if rpcstr is not None:
+                return self._sendRPC(rpcstr)
+        return self._sendRPC(self._dumps(id, args, keys))
+
     def _sendRPC(self, rpcstr):
         """
             Internal function for sending RPCs.
         """
-        self.send(pack('!H', len(rpcstr)) + rpcstr + RPC_MAGIC)
+        parts = (_HDR.pack(len(rpcstr)), rpcstr, RPC_MAGIC)
+
+        # During a burst the RPC is only queued, _endBurst() sends it
+        if self._burst:
+            self._burst_parts.extend(parts)
+            return
+        self.send(''.join(parts))
+
+    def _beginBurst(self):
+        """
+            Start a burst of RPCs, the RPCs sent until the matching
+            _endBurst() call are written with as few sends as possible.
+            Bursts may be nested.
+        """
+        self._burst += 1
+
+    def _endBurst(self):
+        """
+            End a burst of RPCs and write out the queued RPCs.
+        """
+
+        self._burst -= 1
+        if not self._burst and self._burst_parts:
+            rpcs = ''.join(self._burst_parts)
+            self._burst_parts = []
+            self.send(rpcs)
 
     # Exported events
     def onAuthFail(self):
@@ -324,6 +615,12 @@ class NetRPCSocket(ManagedSocket):
             during authentication.
         """
 
+    def onDecodeFail(self, payload):
+        """
+            Called with the payload of an RPC that could not be decoded,
+            the connection is closed afterwards.
+        """
+
     def onExport(self):
         """
             This method is called upon connecting or accepting and is
@@ -335,3 +632,175 @@ class NetRPCSocket(ManagedSocket):
             Called when both RPC sockets have finished exporting there symbols.
         """
 
+class NetRPCPool(object):
+    """
+        Pool of authenticated RPC connections.
+
+        Connections are kept per (host, port, id) and reused by later calls,
+        so connecting and authenticating is only done once per server.
+        Calls made while a connection is still being set up are queued
+        until the server has exported its symbols.
+    """
+
+    def __init__(self, muxer, key = '', min = 1, max = 16,
+            idle_timeout = 60.0, sock = NetRPCSocket):
+        """
+            muxer: the SocketMultiplexer the connections are made on.
+            key: the authentication key sent to the servers.
+            min: the number of connections kept open even when idle.
+            max: the maximum number of open connections, the least
+            recently used connection is closed to make room for a new one.
+            idle_timeout: the number of seconds after which idle connections
+            beyond 'min' are closed.
+            sock: the NetRPCSocket class used for new connections.
+        """
+
+        self.muxer = muxer
+        self.key = key
+        self.min, self.max = min, max
+        self.idle_timeout = idle_timeout
+        self._sock = sock
+
+        # Connections in least recently used order
+        self._conns = OrderedDict()
+
+        # Calls queued until their connection has imported its symbols
+        self._pending = {}
+
+        # Connections used since their last idle check
+        self._used = set()
+
+    def call(self, server, symname, args = (), keys = None):
+        """
+            Call 'symname' on 'server' with the positional arguments 'args'
+            and the keyword arguments 'keys', connecting to the server first
+            if needed. 'server' is a (host, port, id) tuple naming the RPC
+            server at host:port identified as 'id'.
+
+            Returns False if the server does not export 'symname', the
+            connection was refused right away, or every pooled connection
+            is still being set up so none can be closed to make room.
+            Calls queued while connecting are lost if the connection is
+            refused or fails authentication later on.
+        """
+
+        if keys is None:
+            keys = _EMPTY
+        key = tuple(server)
+        sock = self._conns.pop(key, None)
+        if sock is None:
+            sock = self._connect(key)
+            if sock is None:
+                return False
+        self._conns[key] = sock
+        self._used.add(key)
+
+        if key in self._pending:
+            self._pending[key].append((symname, args, keys))
+            return True
+
+        rpc = sock.importRPC(symname)
+        if rpc is None:
+            return False
+        rpc(*args, **keys)
+        return True
+
+    def close(self):
+        """
+            Close all connections in the pool.
+        """
+        for key, sock in self._conns.items():
+            self._drop(key, sock)
+
+    def _connect(self, key):
+        """
+            Open a new pooled connection, returns None if it was refused
+            or there is no room for it.
+        """
+
+        # Make room by closing the least recently used connection, but
+        # never one whose queued calls haven't been sent yet
+        while len(self._conns) >= self.max:
+            for old in self._conns:
+                if old not in self._pending:
+                    break
+            else:
+                return None
+            self._drop(old, self._conns[old])
+
+        host, port, id = key
+        sock = self._sock(self.muxer, host, port)
+        sock.setIdentification(id)
+        sock.setAuthentication(self.key)
+
+        drop = lambda: self._drop(key, sock)
+        self._hook(sock, 'onImport', lambda: self._onImport(key, sock))
+        self._hook(sock, 'onDisconnect', drop)
+        self._hook(sock, 'onConnectionRefuse', drop)
+        self._hook(sock, 'onAuthFail', drop)
+
+        if not sock.connect():
+            sock.close()
+            return None
+        self._pending[key] = []
+        return sock
+
+    def _hook(self, sock, event, handler):
+        """
+            Make 'handler' run after the 'event' callback of 'sock'.
+        """
+
+        callback = getattr(sock, event)
+        def hooked():
+            callback()
+            handler()
+        setattr(sock, event, hooked)
+
+    def _onImport(self, key, sock):
+        """
+            Send the calls queued while the connection was set up.
+        """
+
+        if self._conns.get(key) is not sock:
+            return
+
+        sock._beginBurst()
+        try:
+            for symname, args, keys in self._pending.pop(key, []):
+                rpc = sock.importRPC(symname)
+                if rpc is not None:
+                    rpc(*args, **keys)
+        finally:
+            sock._endBurst()
+
+        self.muxer.eq.scheduleEvent(PeriodicCall(self.idle_timeout,
+            self._checkIdle, key, sock))
+
+    def _checkIdle(self, key, sock):
+        """
+            Close the connection if it was not used since the last check
+            and the pool holds more than 'min' connections.
+            Returns True as long as the connection should be checked.
+        """
+
+        if self._conns.get(key) is not sock:
+            return False
+        if key in self._used:
+            self._used.discard(key)
+            return True
+        if len(self._conns) <= self.min:
+            return True
+        self._drop(key, sock)
+        return False
+
+    def _drop(self, key, sock):
+        """
+            Remove a connection from the pool and close it.
+        """
+
+        if self._conns.get(key) is not sock:
+            return
+        del self._conns[key]
+        self._pending.pop(key, None)
+        self._used.discard(key)
+        sock.close()
@@ -12,12 +12,18 @@ from socket import socketpair, error as socket_error
 from mulsoc import ManagedSocket
 from os import fork, waitpid
 from errno import EINTR
-from struct import pack, unpack, calcsize
+from struct import Struct
 
 RPC_ARG_STR, RPC_ARG_INT = range(2)
-RPC_HEADSIZE = calcsize('II')
-RPC_ARGSIZE = calcsize('Ii')
-del calcsize
+
+# Precompiled call header and argument header formats
+_HDR = Struct('II')
+_ARG = Struct('Ii')
+RPC_HEADSIZE = _HDR.size
+RPC_ARGSIZE = _ARG.size
+
+# Amount of consumed stream data tolerated before compacting the buffer
+RPC_STREAM_COMPACT = 65536
 
 class RemoteProcedureCall(object):
     """
@@ -50,17 +56,17 @@ class RemoteProcedureCall(object):
             if t is not int and t is not str:
                 raise TypeError("Argument %i has type '%s'" % (i, repr(t)))
 
-        # Prepare Call Request
-        crq = pack('II', self.code, len(argv))
+        # Prepare Call Request, the parts are only joined when written
+        parts = [_HDR.pack(self.code, len(argv))]
         for a in argv:
             if type(a) is str:
-                crq += pack('Ii', RPC_ARG_STR, len(a))
-                crq += a
+                parts.append(_ARG.pack(RPC_ARG_STR, len(a)))
+                parts.append(a)
             else:
-                crq += pack('Ii', RPC_ARG_INT, a)
+                parts.append(_ARG.pack(RPC_ARG_INT, a))
 
         # Send call to other process
-        self.rpcbridge.send(crq)
+        self.rpcbridge._sendParts(parts)
 
 class ForkedRPCBridge(ManagedSocket):
     """
@@ -88,7 +94,11 @@ class ForkedRPCBridge(ManagedSocket):
         self.curhead = None
         self.curarg = None
         self.curargv = []
-        self.stream = ''
+        self.stream = bytearray()
+        self._pos = 0
+
+        # Strings queued for writing, see _sendParts()
+        self._wparts = []
 
         self.onPreFork()
         try:
@@ -113,60 +123,119 @@ class ForkedRPCBridge(ManagedSocket):
         """
             Handle call requests coming from the other end of the bridge.
         """
-        self.stream += data
+        self.stream.extend(data)
         while self.handleStream(): pass
 
+        # Drop consumed data, without moving the buffer on every call
+        if self._pos == len(self.stream):
+            del self.stream[:]
+            self._pos = 0
+        elif self._pos > RPC_STREAM_COMPACT:
+            del self.stream[:self._pos]
+            self._pos = 0
+
     def handleStream(self):
         """
             Handle pending RPC stream.
         """
 
-        if self.curhead is None:
-            if len(self.stream) < RPC_HEADSIZE:
-                return False
-            self.curhead = unpack('II', self.stream[:RPC_HEADSIZE])
-            self.stream = self.stream[RPC_HEADSIZE:]
-
-        code, args = self.curhead
-
-        while True:
-
-            # Perform actual call
-            if len(self.curargv) == args:
-                argv = tuple(self.curargv)
-                self.rpc[code](*argv)
-                self.curhead = None
-                self.curargv = []
-                return True
-
-            # Process string component
-            if self.curarg is not None:
-                length, curstr = self.curarg
-                addlen = min(length - len(curstr), len(self.stream))
-                curstr += self.stream[:addlen]
-                self.stream = self.stream[addlen:]
-
-                if len(curstr) == length:
+        # Work on locals, the cursor is stored back on the way out
+        stream, pos = self.stream, self._pos
+        try:
+            if self.curhead is None:
+                if len(stream) - pos < RPC_HEADSIZE:
+                    return False
+                self.curhead = _HDR.unpack_from(stream, pos)
+                pos += RPC_HEADSIZE
+
+            code, args = self.curhead
+            argv = self.curargv
+
+            while True:
+
+                # Perform actual call
+                if len(argv) == args:
+                    self.curhead = None
+                    self.curargv = []
+                    self.rpc[code](*argv)
+                    return True
+
+                # Process string component
+                if self.curarg is not None:
+                    length, curstr = self.curarg
+                    addlen = min(length - len(curstr), len(stream) - pos)
+                    curstr += stream[pos:pos + addlen]
+                    pos += addlen
+
+                    if len(curstr) < length:
+                        return False
                     self.curarg = None
-                    self.curargv.append(curstr)
+                    argv.append(bytes(curstr))
                     continue
-                else:
-                    self.curarg = (length, curstr)
-                    return False
 
-            # Process argument headers / integer arguments
-            if len(self.stream) >= RPC_ARGSIZE:
-                type, value = unpack('Ii', self.stream[:RPC_ARGSIZE])
-                self.stream = self.stream[RPC_ARGSIZE:]
+                # Process argument headers / integer arguments
+                if len(stream) - pos < RPC_ARGSIZE:
+                    return False
+                type, value = _ARG.unpack_from(stream, pos)
+                pos += RPC_ARGSIZE
 
                 if type == RPC_ARG_INT:
-                    self.curargv.append(value)
-                    continue
+                    argv.append(value)
+
+                # Strings that arrived whole are taken straight from the stream
+                elif len(stream) - pos >= value:
+                    argv.append(bytes(stream[pos:pos + value]))
+                    pos += value
                 else:
-                    self.curarg = (value, '')
-                    continue
+                    self.curarg = (value, bytearray())
+        finally:
+            self._pos = pos
+
+    def send(self, data):
+        """
+            Send data to the other process.
+        """
+        return self._sendParts([data])
+
+    def _sendParts(self, parts):
+        """
+            Send a list of strings to the other process.
+
+            The strings are written immediately, as ManagedSocket.send
+            does. While an earlier write is blocked they are only queued,
+            so every call made until the bridge is writable again is
+            joined once and shares a single write.
+        """
+
+        if not self.isConnected():
+            return False
+        self._wparts.extend(parts)
+        if not self._lwb:
+            self.handleWrite()
+        return True
+
+    def handleWrite(self):
+        """
+            Move the queued strings to the write buffer and write it.
+        """
+
+        if self._wparts:
+            self._wparts.insert(0, self._wbuf)
+            self._wbuf = ''.join(self._wparts)
+            self._wparts = []
+        return ManagedSocket.handleWrite(self)
+
+    def bytesInSendQueue(self):
+        return len(self._wbuf) + sum(map(len, self._wparts))
+
+    def close(self):
+        """
+            Flush any queued call requests and close the bridge.
+        """
 
-        return False
+        if self.isConnected():
+            self.handleWrite()
+        return ManagedSocket.close(self)
 
     def onDisconnect(self):
         """